@@ -23,6 +23,46 @@ function appendMessage(content, sender, isHTML = false) {
   return msgDiv;
 }
 
+// -------------------- Streamed agent reply --------------------
+// The agent endpoint answers with NDJSON: one line with the reply text,
+// then one line per audio chunk as soon as Murf has synthesized it.
+async function playAgentStream(response, onReply) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let playback = Promise.resolve();
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+
+    buffer += decoder.decode(value, { stream: true });
+    const lines = buffer.split("\n");
+    buffer = lines.pop();
+
+    for (const line of lines) {
+      if (!line.trim()) continue;
+      const data = JSON.parse(line);
+      if (data.audio_url) {
+        // Queue chunks so playback starts with the first one and stays in order
+        playback = playback.then(() => playAudio(data.audio_url));
+      } else {
+        onReply(data);
+      }
+    }
+  }
+
+  await playback;
+}
+
+function playAudio(url) {
+  const audio = new Audio(url);
+  return new Promise(resolve => {
+    audio.onended = resolve;
+    audio.play();
+  });
+}
+
 // -------------------- TEXT to LLM+TTS --------------------
 async function submitText() {
   const input = document.getElementById("textInput");
@@ -41,24 +81,19 @@ async function submitText() {
       body: JSON.stringify({ text: text })
     });
 
-    const data = await response.json();
-    loadingMsg.remove();
-
-    if (!data.success) {
-      console.error(`Stage ${data.stage} failed: ${data.error}`);
-      return;
-    }
+    let failed = false;
+    await playAgentStream(response, data => {
+      loadingMsg.remove();
 
-    appendMessage(data.gemini_text, "bot");
+      if (!data.success) {
+        console.error(`Stage ${data.stage} failed: ${data.error}`);
+        failed = true;
+        return;
+      }
 
-    // Play all returned audio files sequentially
-    for (let url of data.audio_urls) {
-      const audio = new Audio(url);
-      await new Promise(resolve => {
-        audio.onended = resolve;
-        audio.play();
-      });
-    }
+      appendMessage(data.gemini_text, "bot");
+    });
+    if (failed) return;
 
     startBtn.click(); // Restart mic
   } catch (err) {
@@ -124,24 +159,16 @@ async function uploadAndLLM() {
 
     if (!response.ok) throw new Error("Agent chat failed");
 
-    const data = await response.json();
-    statusMsg.remove();
-
-    // Show last user message from history
-    const userMsg = data.history[data.history.length - 2]?.content || "";
-    appendMessage(userMsg, "user");
+    await playAgentStream(response, data => {
+      statusMsg.remove();
 
-    // Show assistant reply
-    appendMessage(data.gemini_text, "bot");
+      // Show last user message from history
+      const userMsg = data.history[data.history.length - 2]?.content || "";
+      appendMessage(userMsg, "user");
 
-    // Play all returned audio files sequentially
-    for (let url of data.audio_urls) {
-      const audio = new Audio(url);
-      await new Promise(resolve => {
-        audio.onended = resolve;
-        audio.play();
-      });
-    }
+      // Show assistant reply
+      appendMessage(data.gemini_text, "bot");
+    });
 
     // Restart recording after bot finishes
     startBtn.click();
@@ -1,25 +1,76 @@
+import asyncio
+import anyio.to_thread
+import hashlib
+import re
+import shutil
+import time
+import unicodedata
+import weakref
+import orjson
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import httpx
 from fastapi import FastAPI, HTTPException, UploadFile, File
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
+from fastapi.responses import ORJSONResponse, RedirectResponse, StreamingResponse
 import assemblyai as aai
 from pydantic import BaseModel
-from murf import Murf
 import os
 from dotenv import load_dotenv
-import google.generativeai as genai
 from fastapi import Request
 
-chat_histories = {}
+# Speaker prefixes used when rendering history into the prompt
+ROLE_LABELS = {"user": "User", "assistant": "Assistant"}
 
-def append_to_history(session_id: str, role: str, content: str):
-    """Append a message to a session's chat history."""
-    if session_id not in chat_histories:
-        chat_histories[session_id] = []
-    chat_histories[session_id].append({"role": role, "content": content.strip()})
+# Least recently used sessions are evicted once MAX_CHAT_SESSIONS is reached
+MAX_CHAT_SESSIONS = 10_000
+chat_histories = OrderedDict()
+
+# One lock per active session; a lock disappears once no turn is holding it
+session_locks = weakref.WeakValueDictionary()
+
+def get_session_lock(session_id: str) -> asyncio.Lock:
+    """Return the lock that serializes turns within a session."""
+    lock = session_locks.get(session_id)
+    if lock is None:
+        lock = session_locks[session_id] = asyncio.Lock()
+    return lock
 
-def get_chat_history(session_id: str):
-    """Return the chat history list for a session."""
-    return chat_histories.get(session_id, [])
+# Runs of spaces/tabs between two words; leading indentation is left alone
+INLINE_SPACE_RE = re.compile(r"(?<=\S)[ \t]{2,}(?=\S)")
+
+def normalize_content(content: str) -> str:
+    """Trim user input, collapse gaps between words and NFC-normalize non-ASCII text."""
+    if not content.isascii():
+        # NFC only composes equivalent sequences; unlike NFKC it keeps ², ½, ™ etc.
+        content = unicodedata.normalize("NFC", content)
+    return INLINE_SPACE_RE.sub(" ", content.strip())
+
+def append_to_history(session_id: str, role: str, content: str):
+    """Append a message to a session's history and return the session entry."""
+    entry = chat_histories.get(session_id)
+    if entry is None:
+        entry = chat_histories[session_id] = {"encoded": [], "text": ""}
+        while len(chat_histories) > MAX_CHAT_SESSIONS:
+            evicted, _ = chat_histories.popitem(last=False)
+            drop_context_cache(evicted)
+    else:
+        chat_histories.move_to_end(session_id)
+    # Assistant replies are stored as generated so code and formatting survive
+    content = normalize_content(content) if role == "user" else content.strip()
+    # Messages never change once appended, so serialize each one exactly once
+    entry["encoded"].append(orjson.dumps({"role": role, "content": content}))
+    # Keep the "User: ..." / "Assistant: ..." transcript up to date so a turn
+    # never has to re-render the whole history
+    line = f"{ROLE_LABELS.get(role, 'Assistant')}: {content}"
+    entry["text"] = f"{entry['text']}\n{line}" if entry["text"] else line
+    return entry
+
+def get_history_json(session_id: str) -> bytes:
+    """Return a session's chat history as a JSON array, built from pre-serialized messages."""
+    entry = chat_histories.get(session_id)
+    return b"[" + b",".join(entry["encoded"]) + b"]" if entry else b"[]"
 
 # Load environment variables
 load_dotenv()
@@ -33,11 +84,241 @@ if not GEMINI_API_KEY:
 
 # Setup clients
 aai.settings.api_key = ASSEMBLYAI_API_KEY
+# The SDK polls for finished transcripts every 3s by default, which dominates
+# latency for the short utterances a voice agent deals with
+aai.settings.polling_interval = float(os.getenv("ASSEMBLYAI_POLLING_INTERVAL", "0.5"))
 transcriber = aai.Transcriber()
-genai.configure(api_key=GEMINI_API_KEY)
+
+# One pooled HTTP/2 client for every Murf and Gemini call, so connections and
+# TLS sessions are reused across requests; opened and closed in the app lifespan
+http_client: httpx.AsyncClient = None
+
+MURF_TTS_URL = "https://api.murf.ai/v1/speech/generate"
+GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta"
+
+# Cap concurrent Murf requests across all users to stay under its rate limit
+MURF_CONCURRENCY = int(os.getenv("MURF_CONCURRENCY", "10"))
+# Created in the app lifespan so it belongs to the running event loop
+murf_semaphore: asyncio.Semaphore = None
+# (text, voice_id) -> {"task": in-flight Murf request, "waiters": callers awaiting it}
+murf_inflight = {}
+
+async def request_murf_tts(text: str, voice_id: str) -> str:
+    """POST a single synthesis request to Murf and return the audio URL."""
+    async with murf_semaphore:
+        response = await http_client.post(
+            MURF_TTS_URL,
+            headers={"api-key": MURF_API_KEY},
+            json={"text": text, "voiceId": voice_id}
+        )
+    response.raise_for_status()
+    return response.json()["audioFile"]
+
+def finish_murf_request(key, shared, task: asyncio.Task):
+    """Forget a finished Murf request and mark its exception as retrieved."""
+    if murf_inflight.get(key) is shared:
+        del murf_inflight[key]
+    if not task.cancelled():
+        task.exception()
+
+async def murf_tts(text: str, voice_id: str = "en-UK-peter") -> str:
+    """Synthesize text with Murf, sharing one upstream call between identical concurrent requests."""
+    key = (text, voice_id)
+    shared = murf_inflight.get(key)
+    if shared is None:
+        task = asyncio.create_task(request_murf_tts(text, voice_id))
+        shared = murf_inflight[key] = {"task": task, "waiters": 0}
+        task.add_done_callback(lambda t: finish_murf_request(key, shared, t))
+    task = shared["task"]
+    shared["waiters"] += 1
+    try:
+        # Shield the shared request so one caller going away doesn't cancel it for the rest
+        return await asyncio.shield(task)
+    finally:
+        shared["waiters"] -= 1
+        # Once nobody is left waiting, stop the upstream call and free its semaphore slot
+        if not shared["waiters"] and not task.done():
+            if murf_inflight.get(key) is shared:
+                del murf_inflight[key]
+            task.cancel()
+
+async def gemini_request(method: str, path: str, **kwargs):
+    """Call the Gemini REST API and return the decoded JSON body."""
+    response = await http_client.request(
+        method,
+        f"{GEMINI_API_URL}/{path}",
+        headers={"x-goog-api-key": GEMINI_API_KEY},
+        **kwargs
+    )
+    response.raise_for_status()
+    return response.json()
+
+async def gemini_generate(model_name: str, prompt: str, cached_content: str = None) -> str:
+    """Generate a reply from a Gemini model, optionally on top of a cached context."""
+    if not model_name.startswith("models/"):
+        model_name = f"models/{model_name}"
+    body = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+    if cached_content:
+        body["cachedContent"] = cached_content
+    data = await gemini_request("POST", f"{model_name}:generateContent", json=body)
+    candidates = data.get("candidates") or []
+    if not candidates:
+        # The whole prompt was blocked; promptFeedback carries the blockReason
+        raise ValueError(f"Gemini returned no candidates (promptFeedback: {data.get('promptFeedback')})")
+    parts = candidates[0].get("content", {}).get("parts")
+    if not parts:
+        raise ValueError(f"Gemini returned no content (finishReason: {candidates[0].get('finishReason')})")
+    return "".join(part.get("text", "") for part in parts)
+
+# -------------------- LLM RESPONSE CACHE --------------------
+# Opt-in: set LLM_CACHE_ENABLED=1 to reuse Gemini replies for repeated prompts
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "0") == "1"
+LLM_CACHE_MAXSIZE = int(os.getenv("LLM_CACHE_MAXSIZE", "10000"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))
+
+# key -> (expires_at, response_text), oldest first
+llm_cache = OrderedDict()
+
+def normalize_prompt(prompt: str) -> str:
+    """Collapse whitespace and case so near-duplicate prompts share a cache entry."""
+    return " ".join(prompt.split()).casefold()
+
+def llm_cache_key(model_name: str, prompt: str) -> bytes:
+    """Hash the model name and normalized prompt into a compact cache key."""
+    raw = f"{model_name}\0{normalize_prompt(prompt)}".encode()
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+async def cached_generate(model_name: str, prompt: str) -> str:
+    """Return Gemini's reply text, serving repeated prompts from the cache when enabled."""
+    if LLM_CACHE_ENABLED:
+        key = llm_cache_key(model_name, prompt)
+        entry = llm_cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            llm_cache.move_to_end(key)
+            return entry[1]
+
+    text = await gemini_generate(model_name, prompt)
+
+    if LLM_CACHE_ENABLED:
+        llm_cache[key] = (time.monotonic() + LLM_CACHE_TTL, text)
+        llm_cache.move_to_end(key)
+        while len(llm_cache) > LLM_CACHE_MAXSIZE:
+            llm_cache.popitem(last=False)
+    return text
+
+# -------------------- AGENT CONTEXT CACHE --------------------
+AGENT_MODEL = "gemini-1.5-flash"
+AGENT_SYSTEM_INSTRUCTION = (
+    "You are a friendly AI voice assistant.\n"
+    "Continue the conversation naturally based on the following history:"
+)
+# Gemini only caches contexts above a minimum token count (~4 chars per token),
+# and cached contents need an explicitly versioned model
+CONTEXT_CACHE_MODEL = os.getenv("CONTEXT_CACHE_MODEL", "models/gemini-1.5-flash-002")
+CONTEXT_CACHE_MIN_CHARS = int(os.getenv("CONTEXT_CACHE_MIN_CHARS", str(32768 * 4)))
+CONTEXT_CACHE_TTL = "600s"
+# Past the opening turns an agent prompt embeds the whole conversation and
+# never repeats, so it goes straight to Gemini instead of filling the LLM cache
+AGENT_CACHE_MAX_PROMPT_CHARS = int(os.getenv("AGENT_CACHE_MAX_PROMPT_CHARS", "4000"))
+
+# session_id -> {"name": cachedContents/... name, "offset": length of history text it covers}
+context_caches = {}
+# Fire-and-forget cleanup tasks, referenced here so they aren't garbage collected
+background_tasks = set()
+
+async def delete_context_cache(name: str):
+    """Delete a cached context on Gemini's side; it expires on its own if this fails."""
+    try:
+        await gemini_request("DELETE", name)
+    except Exception:
+        pass
+
+def drop_context_cache(session_id: str):
+    """Forget a session's context cache and stop Gemini billing for its storage."""
+    cached = context_caches.pop(session_id, None)
+    if cached:
+        task = asyncio.create_task(delete_context_cache(cached["name"]))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+def context_cache_gone(exc: Exception) -> bool:
+    """Tell whether a Gemini error means the cached content no longer exists."""
+    return isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code in (403, 404)
+
+async def generate_agent_reply(session_id: str, history_text: str) -> str:
+    """Generate the assistant's next turn, caching long histories on Gemini's side."""
+    cached = context_caches.get(session_id)
+    if cached is None and len(history_text) >= CONTEXT_CACHE_MIN_CHARS:
+        try:
+            cache = await gemini_request("POST", "cachedContents", json={
+                "model": CONTEXT_CACHE_MODEL,
+                "systemInstruction": {"parts": [{"text": AGENT_SYSTEM_INSTRUCTION}]},
+                "contents": [{"role": "user", "parts": [{"text": history_text}]}],
+                "ttl": CONTEXT_CACHE_TTL
+            })
+            cached = context_caches[session_id] = {"name": cache["name"], "offset": len(history_text)}
+        except Exception:
+            cached = None
+
+    if cached:
+        # Only the turns after the cached prefix are sent; refresh the TTL alongside.
+        # A failed refresh alone shouldn't cost us a good reply.
+        prompt = f"{history_text[cached['offset']:].lstrip()}\n\nAssistant:"
+        reply, _ = await asyncio.gather(
+            gemini_generate(CONTEXT_CACHE_MODEL, prompt, cached_content=cached["name"]),
+            gemini_request(
+                "PATCH", cached["name"],
+                params={"updateMask": "ttl"},
+                json={"ttl": CONTEXT_CACHE_TTL}
+            ),
+            return_exceptions=True
+        )
+        if not isinstance(reply, Exception):
+            return reply
+        if not context_cache_gone(reply):
+            # Rate limits, server errors and blocked replies would fail the same
+            # way with the full history, so let agent_chat use its fallback text
+            raise reply
+        # The cached content expired or was deleted; resend the full history
+        drop_context_cache(session_id)
+
+    prompt = f"""
+{AGENT_SYSTEM_INSTRUCTION}
+
+{history_text}
+
+Assistant:
+"""
+    if len(prompt) > AGENT_CACHE_MAX_PROMPT_CHARS:
+        return await gemini_generate(AGENT_MODEL, prompt)
+    return await cached_generate(AGENT_MODEL, prompt)
 
 # FastAPI app setup
-app = FastAPI()
+# AssemblyAI transcriptions hold a worker thread while they upload and poll,
+# so the default pools (40 for sync routes, ~32 for to_thread) fill up fast
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "200"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client, murf_semaphore
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(THREADPOOL_SIZE))
+    murf_semaphore = asyncio.Semaphore(MURF_CONCURRENCY)
+    murf_inflight.clear()
+    # Built per startup so a restarted app never inherits a closed client
+    http_client = httpx.AsyncClient(
+        http2=True,
+        # Non-streaming generateContent and long Murf syntheses send nothing
+        # until they finish, so reads get far longer than connect/write/pool
+        timeout=httpx.Timeout(10, read=120),
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)
+    )
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 
 
@@ -61,39 +342,48 @@ class TTSRequest(BaseModel):
     style: str = "Conversational"
 
 @app.post("/tts")
-def generate_tts(request: TTSRequest):
+async def generate_tts(request: TTSRequest):
     try:
-        client = Murf(api_key=MURF_API_KEY)
-        response = client.text_to_speech.generate(
-            text=request.text,
-            voice_id=request.voiceId
-        )
-        return {"audio_url": response.audio_file}
+        audio_url = await murf_tts(request.text, request.voiceId)
+        return {"audio_url": audio_url}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"TTS generation failed: {str(e)}")
 
 # -------------------- FILE UPLOAD --------------------
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Only blocking file I/O happens here, so FastAPI runs it in the threadpool
 @app.post("/upload")
-async def upload_audio(file: UploadFile = File(...)):
+def upload_audio(file: UploadFile = File(...)):
     try:
         file_location = f"uploads/{file.filename}"
         with open(file_location, "wb") as f:
-            f.write(await file.read())
+            shutil.copyfileobj(file.file, f, UPLOAD_CHUNK_SIZE)
+            size = os.fstat(f.fileno()).st_size
         return {
             "filename": file.filename,
             "content_type": file.content_type,
-            "size": os.path.getsize(file_location)
+            "size": size
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
 # -------------------- TRANSCRIBE --------------------
+MAX_AUDIO_BYTES = 25 * 1024 * 1024
+
+def audio_source(file: UploadFile):
+    """Return the upload's spooled file for AssemblyAI, rejecting oversized audio."""
+    if file.size is not None and file.size > MAX_AUDIO_BYTES:
+        raise HTTPException(status_code=413, detail="Audio file too large")
+    return file.file
+
 @app.post("/transcribe/file")
-async def transcribe_audio(file: UploadFile = File(...)):
+def transcribe_audio(file: UploadFile = File(...)):
     try:
-        audio_bytes = await file.read()
-        transcript = transcriber.transcribe(audio_bytes)
+        transcript = transcriber.transcribe(audio_source(file))
         return {"transcription": transcript.text}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Transcription failed: {str(e)}")
 
@@ -101,20 +391,17 @@ async def transcribe_audio(file: UploadFile = File(...)):
 @app.post("/tts/echo")
 async def echo_with_murf(file: UploadFile = File(...)):
     try:
-        audio_bytes = await file.read()
-        transcript = transcriber.transcribe(audio_bytes)
+        transcript = await asyncio.to_thread(transcriber.transcribe, audio_source(file))
         text = transcript.text
 
-        client = Murf(api_key=MURF_API_KEY)
-        response = client.text_to_speech.generate(
-            text=text,
-            voice_id="en-UK-peter"
-        )
+        audio_url = await murf_tts(text)
 
         return {
             "transcription": text,
-            "audio_url": response.audio_file
+            "audio_url": audio_url
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Echo failed: {str(e)}")
 
@@ -126,9 +413,8 @@ class LLMRequest(BaseModel):
 @app.post("/llm/query")
 async def llm_query(request: LLMRequest):
     try:
-        model = genai.GenerativeModel(request.model)
-        response = model.generate_content(request.text)
-        return {"response": response.text}
+        response_text = await cached_generate(request.model, request.text)
+        return {"response": response_text}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"LLM query failed: {str(e)}")
 
@@ -137,31 +423,26 @@ async def llm_query(request: LLMRequest):
 async def llm_query_audio(file: UploadFile = File(...), model: str = "gemini-1.5-flash"):
     try:
         # 1️⃣ Transcribe user audio
-        audio_bytes = await file.read()
-        transcript = transcriber.transcribe(audio_bytes)
+        transcript = await asyncio.to_thread(transcriber.transcribe, audio_source(file))
         user_text = transcript.text
 
         # 2️⃣ Get LLM response
-        gemini_model = genai.GenerativeModel(model)
-        llm_response = gemini_model.generate_content(user_text)
-        response_text = llm_response.text.strip()
+        response_text = (await cached_generate(model, user_text)).strip()
 
         # 3️⃣ Ensure <= 3000 chars for Murf
         if len(response_text) > 3000:
             response_text = response_text[:2995] + "..."
 
         # 4️⃣ Generate TTS
-        murf_client = Murf(api_key=MURF_API_KEY)
-        tts_result = murf_client.text_to_speech.generate(
-            text=response_text,
-            voice_id="en-UK-peter"
-        )
+        audio_url = await murf_tts(response_text)
 
         return {
             "user_transcription": user_text,
             "llm_response": response_text,
-            "audio_url": tts_result.audio_file
+            "audio_url": audio_url
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"LLM audio query failed: {str(e)}")
 
@@ -169,35 +450,79 @@ async def llm_query_audio(file: UploadFile = File(...), model: str = "gemini-1.5
 async def llm_query_text(request: LLMRequest):
     try:
         # 1️⃣ LLM response
-        model = genai.GenerativeModel(request.model)
-        llm_response = model.generate_content(request.text)
-        response_text = llm_response.text.strip()
+        response_text = (await cached_generate(request.model, request.text)).strip()
 
         # 2️⃣ Ensure <= 3000 chars for Murf
         if len(response_text) > 3000:
             response_text = response_text[:2995] + "..."
 
         # 3️⃣ Generate TTS from LLM response
-        murf_client = Murf(api_key=MURF_API_KEY)
-        tts_result = murf_client.text_to_speech.generate(
-            text=response_text,
-            voice_id="en-UK-peter"
-        )
+        audio_url = await murf_tts(response_text)
 
         return {
             "llm_response": response_text,
-            "audio_url": tts_result.audio_file
+            "audio_url": audio_url
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"LLM text query failed: {str(e)}") 
     
 
 
+# Murf rejects text longer than this in a single request
+MURF_MAX_CHARS = 3000
+# A sentence and its trailing whitespace, or a final fragment without punctuation
+SENTENCE_RE = re.compile(r"[^.!?]*[.!?]+\s*|[^.!?]+")
+
+def chunk_text(text: str, max_len: int = MURF_MAX_CHARS):
+    """Split text into Murf-sized chunks, packing whole sentences where possible."""
+    bounds = []
+    start = end = 0
+    for match in SENTENCE_RE.finditer(text):
+        sentence_end = match.end()
+        if sentence_end - start <= max_len:
+            end = sentence_end
+            continue
+        if end > start:
+            bounds.append((start, end))
+            start = end
+        # A single sentence longer than max_len has to be hard-split; the number
+        # of full-size pieces is computed directly rather than found by looping
+        pieces = (sentence_end - start - 1) // max_len
+        split_end = start + pieces * max_len
+        bounds.extend((i, i + max_len) for i in range(start, split_end, max_len))
+        start = split_end
+        end = sentence_end
+    if end > start:
+        bounds.append((start, end))
+    return [text[i:j] for i, j in bounds]
+
+def agent_response(gemini_text: str, session_id: str, tts_tasks=()):
+    """Stream the agent reply as NDJSON: the text first, then one audio URL per chunk."""
+    # Splice the cached history JSON in rather than re-serializing every message
+    header = orjson.dumps({"success": True, "gemini_text": gemini_text})
+    header = header[:-1] + b',"history":' + get_history_json(session_id) + b"}\n"
+
+    async def generate():
+        yield header
+        try:
+            # Chunks are already synthesizing concurrently; flush each one in order
+            for task in tts_tasks:
+                try:
+                    audio_url = await task
+                except Exception:
+                    continue
+                yield orjson.dumps({"audio_url": audio_url}) + b"\n"
+        finally:
+            for task in tts_tasks:
+                task.cancel()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
 @app.post("/agent/chat/{session_id}")
 async def agent_chat(session_id: str, request: Request):
     try:
         content_type = request.headers.get("content-type", "")
-        file_bytes = None
+        audio_file = None
         input_text = None
 
         # --- Handle input (audio or text) ---
@@ -206,7 +531,8 @@ async def agent_chat(session_id: str, request: Request):
                 form = await request.form()
                 if "file" in form and hasattr(form["file"], "filename"):
                     upload_file: UploadFile = form["file"]
-                    file_bytes = await upload_file.read()
+                    if upload_file.size:
+                        audio_file = upload_file
                 if "text" in form:
                     input_text = form["text"].strip()
 
@@ -220,77 +546,53 @@ async def agent_chat(session_id: str, request: Request):
             input_text = None
 
         # --- STT ---
-        if file_bytes:
+        if audio_file:
             try:
-                transcript = transcriber.transcribe(file_bytes)
+                transcript = await asyncio.to_thread(transcriber.transcribe, audio_source(audio_file))
                 input_text = transcript.text
             except Exception:
-                return {
-                    "success": True,
-                    "gemini_text": "Sorry, I couldn’t process the audio.",
-                    "audio_urls": [],
-                    "history": get_chat_history(session_id)
-                }
+                return agent_response("Sorry, I couldn’t process the audio.", session_id)
 
         if not input_text:
-            return {
-                "success": True,
-                "gemini_text": "I didn’t catch anything. Can you try again?",
-                "audio_urls": [],
-                "history": get_chat_history(session_id)
-            }
-
-        append_to_history(session_id, "user", input_text)
+            return agent_response("I didn’t catch anything. Can you try again?", session_id)
 
-        # --- Gemini LLM ---
-        try:
-            history_text = "\n".join(
-                f"{'User' if msg['role']=='user' else 'Assistant'}: {msg['content']}"
-                for msg in get_chat_history(session_id)
-            )
-            prompt = f"""
-You are a friendly AI voice assistant.
-Continue the conversation naturally based on the following history:
-
-{history_text}
+        # Hold the session lock for the whole turn so concurrent requests
+        # can't interleave their user/assistant messages
+        async with get_session_lock(session_id):
+            session = append_to_history(session_id, "user", input_text)
 
-Assistant:
-"""
-            model = genai.GenerativeModel("gemini-1.5-flash")
-            llm_response = model.generate_content(prompt)
-            gemini_text = getattr(llm_response, "text", None) or \
-                          getattr(llm_response.candidates[0].content.parts[0], "text", "No response.")
-        except Exception:
-            gemini_text = "I had trouble thinking of a reply, but let's keep going."
+            # --- Gemini LLM ---
+            try:
+                gemini_text = await generate_agent_reply(session_id, session["text"]) or "No response."
+            except Exception:
+                gemini_text = "I had trouble thinking of a reply, but let's keep going."
 
-        append_to_history(session_id, "assistant", gemini_text)
+            append_to_history(session_id, "assistant", gemini_text)
 
         # --- TTS ---
-        audio_urls = []
-        try:
-            def chunk_text(text, max_len=3000):
-                return [text[i:i+max_len] for i in range(0, len(text), max_len)]
-            for chunk in chunk_text(gemini_text):
-                client = Murf(api_key=MURF_API_KEY)
-                tts_response = client.text_to_speech.generate(
-                    text=chunk,
-                    voice_id="en-UK-peter"
-                )
-                audio_urls.append(tts_response.audio_file)
-        except Exception:
-            audio_urls = []
+        tts_tasks = [
+            asyncio.create_task(murf_tts(chunk))
+            for chunk in chunk_text(gemini_text)
+        ]
 
-        return {
-            "success": True,
-            "gemini_text": gemini_text,
-            "audio_urls": audio_urls,
-            "history": get_chat_history(session_id)
-        }
+        return agent_response(gemini_text, session_id, tts_tasks)
 
     except Exception:
-        return {
-            "success": True,
-            "gemini_text": "Something unexpected happened, but I’m still here!",
-            "audio_urls": [],
-            "history": get_chat_history(session_id)
-        }
+        return agent_response("Something unexpected happened, but I’m still here!", session_id)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvicorn picks uvloop and httptools automatically when they are installed.
+    # Chat histories live in process memory, so keep a single worker unless
+    # sessions are moved to shared storage.
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "127.0.0.1"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        access_log=False
+    )